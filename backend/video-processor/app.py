@@ -6,37 +6,100 @@ Flask application for video encoding and processing using FFmpeg
 
 import os
 import json
+import hashlib
+import shutil
+import mimetypes
+import tempfile
 import uuid
+from collections import namedtuple
+from functools import lru_cache
+from fractions import Fraction
 import subprocess
+from urllib.parse import unquote_plus, urlparse
+from urllib.request import urlopen
 import threading
+import time
+import glob
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify, make_response, send_from_directory
 from flask_cors import CORS
 import redis
+import msgpack
+import zstandard
+from rq import Queue, Retry, get_current_job
 import boto3
+from boto3.s3.transfer import TransferConfig
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 
-app = Flask(__name__)
-CORS(app)
+# PyAV (optional) reads metadata in-process instead of spawning ffprobe
+try:
+    import av
+except ImportError:
+    av = None
 
 # Configuration
-UPLOAD_FOLDER = '/tmp/uploads'
+# Uploads are kept in memory-backed storage when available so FFmpeg reads
+# them back without a disk round-trip
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', '/dev/shm/vidiox_uploads' if os.path.isdir('/dev/shm') else '/tmp/uploads')
 PROCESSED_FOLDER = '/tmp/processed'
-ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'wmv', 'flv', 'webm', 'mkv'}
+ALLOWED_EXTENSIONS = frozenset({'mp4', 'avi', 'mov', 'wmv', 'flv', 'webm', 'mkv'})
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', 2 * 1024 * 1024 * 1024))  # 2GB limit
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+HLS_SEGMENT_SECONDS = 4
+
+# Python maps .ts to Qt translation files by default
+mimetypes.add_type('video/mp2t', '.ts')
+
+# Internal nginx location that serves PROCESSED_FOLDER (e.g. /_internal_processed/).
+# When set, file downloads are handed off to nginx with X-Accel-Redirect.
+ACCEL_REDIRECT_PREFIX = os.getenv('ACCEL_REDIRECT_PREFIX')
+
+class UploadRequest(Request):
+    """Request that spools multipart uploads straight into UPLOAD_FOLDER.
+
+    Every spool file is recorded in ``spooled_uploads`` so it can be removed
+    at teardown, including parts that never reach ``request.files``.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, prefix='.upload_', delete=False)
+        if not hasattr(self, 'spooled_uploads'):
+            self.spooled_uploads = []
+        self.spooled_uploads.append(spool.name)
+        return spool
+
+app = Flask(__name__)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
+# Let Apache/lighttpd send files via X-Sendfile
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
+CORS(app)
 
 # Ensure directories exist
 Path(UPLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
 Path(PROCESSED_FOLDER).mkdir(parents=True, exist_ok=True)
 
-# Redis connection for job queue
+REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 64))
+
+# Redis connection for job queue, shared by requests, progress updates and RQ.
+# Responses are left as bytes; callers decode only what they read.
 try:
-    redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+    redis_pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=0,
+                                      max_connections=REDIS_MAX_CONNECTIONS)
+    redis_client = redis.Redis(connection_pool=redis_pool)
     redis_client.ping()
+    job_queue = Queue('encode', connection=redis_client)
 except:
     print("Warning: Redis not available. Job queue functionality will be limited.")
     redis_client = None
+    job_queue = None
 
 # AWS S3 client (optional)
 try:
@@ -46,47 +109,91 @@ except:
     s3_client = None
     print("Warning: AWS S3 not configured. Local storage will be used.")
 
-# Video encoding profiles
+# Multipart settings shared by all S3 uploads
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+
+# Video encoding profiles: quality -> (width, height, video kbps, audio kbps, fps)
+_RAW_ENCODING_PROFILES = {
+    '240p': (426, 240, 400, 64, 30),
+    '360p': (640, 360, 800, 96, 30),
+    '480p': (854, 480, 1200, 128, 30),
+    '720p': (1280, 720, 2500, 192, 30),
+    '1080p': (1920, 1080, 5000, 256, 30)
+}
+
+Profile = namedtuple('Profile', 'width height vbr_bps abr_bps fps res_str vbr_str abr_str')
+
+# Derived fields are computed once at import instead of parsed per job.
+# fps is a Fraction so it can carry NTSC rates like 30000/1001 exactly.
 ENCODING_PROFILES = {
-    '240p': {
-        'resolution': '426x240',
-        'video_bitrate': '400k',
-        'audio_bitrate': '64k',
-        'fps': 30
-    },
-    '360p': {
-        'resolution': '640x360',
-        'video_bitrate': '800k',
-        'audio_bitrate': '96k',
-        'fps': 30
-    },
-    '480p': {
-        'resolution': '854x480',
-        'video_bitrate': '1200k',
-        'audio_bitrate': '128k',
-        'fps': 30
-    },
-    '720p': {
-        'resolution': '1280x720',
-        'video_bitrate': '2500k',
-        'audio_bitrate': '192k',
-        'fps': 30
-    },
-    '1080p': {
-        'resolution': '1920x1080',
-        'video_bitrate': '5000k',
-        'audio_bitrate': '256k',
-        'fps': 30
-    }
+    quality: Profile(width, height, vbr * 1000, abr * 1000, Fraction(fps),
+                     f'{width}x{height}', f'{vbr}k', f'{abr}k')
+    for quality, (width, height, vbr, abr, fps) in _RAW_ENCODING_PROFILES.items()
 }
 
+def get_file_extension(filename):
+    """Return the lowercased extension of filename, or '' if it has none."""
+    _, dot, extension = filename.rpartition('.')
+    return extension.lower() if dot else ''
+
 def allowed_file(filename):
     """Check if the file extension is allowed."""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return get_file_extension(filename) in ALLOWED_EXTENSIONS
 
-def get_video_info(filepath):
-    """Get video metadata using FFprobe."""
+def save_upload(file, output_path):
+    """Move an uploaded file to output_path.
+
+    Uploads spooled by UploadRequest are renamed into place; anything else
+    is copied with a larger buffer than Werkzeug's default.
+    """
+    spool_path = getattr(file.stream, 'name', None)
+    if isinstance(spool_path, str) and os.path.dirname(spool_path) == UPLOAD_FOLDER:
+        file.stream.flush()
+        os.replace(spool_path, output_path)
+        return
+    
+    with open(output_path, 'wb') as out:
+        shutil.copyfileobj(file.stream, out, length=UPLOAD_CHUNK_SIZE)
+
+PROBE_CACHE_TTL = 86400  # Cached probe results expire after 1 day
+
+def _probe_with_pyav(filepath):
+    """Read video metadata in-process with PyAV, in ffprobe's JSON layout.
+
+    Streams PyAV has no decoder for (timecode/metadata tracks, unknown audio
+    codecs) have no codec context and are reported without codec details.
+    """
+    with av.open(filepath) as container:
+        streams = []
+        for stream in container.streams:
+            codec_context = stream.codec_context
+            info = {'codec_type': stream.type, 'codec_name': codec_context.name if codec_context else None}
+            if stream.type == 'video':
+                if not codec_context:
+                    raise ValueError(f"No decoder for video stream {stream.index}")
+                rate = stream.average_rate or stream.guessed_rate or stream.base_rate
+                info.update({
+                    'width': codec_context.width,
+                    'height': codec_context.height,
+                    'r_frame_rate': f"{rate.numerator}/{rate.denominator}" if rate else '30/1'
+                })
+            streams.append(info)
+        
+        return {
+            'format': {
+                'duration': str(container.duration / av.time_base) if container.duration else '0',
+                'bit_rate': str(container.bit_rate or 0)
+            },
+            'streams': streams
+        }
+
+def _probe_with_ffprobe(filepath):
+    """Read video metadata by running FFprobe."""
     cmd = [
         'ffprobe', 
         '-v', 'quiet',
@@ -96,20 +203,54 @@ def get_video_info(filepath):
         filepath
     ]
     
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return json.loads(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Error getting video info: {e}")
-        return None
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+def get_video_info(filepath):
+    """Get video metadata in FFprobe's JSON layout.
+
+    Uses PyAV in-process when installed, and FFprobe otherwise or when PyAV
+    cannot read the file. Results are cached in Redis keyed by path and
+    size, so retried jobs skip the probe.
+    """
+    cache_key = 'probe:' + hashlib.sha1(f"{filepath}:{os.path.getsize(filepath)}".encode()).hexdigest()
+    cached = redis_client.get(cache_key) if redis_client else None
+    if cached:
+        return json.loads(cached)
+    
+    video_info = None
+    if av:
+        try:
+            video_info = _probe_with_pyav(filepath)
+        except Exception as e:
+            print(f"PyAV could not read {filepath}, using FFprobe: {e}")
+    
+    if video_info is None:
+        try:
+            video_info = _probe_with_ffprobe(filepath)
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            print(f"Error getting video info: {e}")
+            return None
+    
+    if redis_client:
+        redis_client.setex(cache_key, PROBE_CACHE_TTL, json.dumps(video_info))
+    return video_info
+
+# Pick the most representative of the next 100 frames rather than a fixed
+# one, so fades and black intros don't end up as the thumbnail. Scaling
+# first keeps the filter's 100-frame buffer small; small sources aren't
+# upscaled.
+THUMBNAIL_FILTER = "scale='min(640,iw)':-2,thumbnail=100"
 
 def create_thumbnail(input_path, output_path, timestamp='00:00:01'):
     """Generate a thumbnail from the video."""
     cmd = [
         'ffmpeg',
-        '-i', input_path,
+        # Seeking before -i jumps to the nearest keyframe instead of decoding up to it
         '-ss', timestamp,
-        '-vframes', '1',
+        '-i', input_path,
+        '-vf', THUMBNAIL_FILTER,
+        '-frames:v', '1',
         '-q:v', '2',
         '-y',
         output_path
@@ -122,41 +263,287 @@ def create_thumbnail(input_path, output_path, timestamp='00:00:01'):
         print(f"Error creating thumbnail: {e}")
         return False
 
-def encode_video(input_path, output_path, profile):
-    """Encode video using FFmpeg with the specified profile."""
-    cmd = [
+VAAPI_DEVICE = os.getenv('VAAPI_DEVICE', '/dev/dri/renderD128')
+
+def _hw_encoder_works(encoder):
+    """Check that the device behind a hardware encoder is usable.
+
+    Distro FFmpeg builds list NVENC/VAAPI even without a GPU, so a
+    one-frame trial encode is run instead of trusting ``-encoders``.
+    """
+    cmd = ['ffmpeg', '-hide_banner', '-v', 'error']
+    if encoder == 'h264_vaapi':
+        cmd += ['-vaapi_device', VAAPI_DEVICE]
+    cmd += ['-f', 'lavfi', '-i', 'nullsrc=s=256x256', '-frames:v', '1']
+    if encoder == 'h264_vaapi':
+        cmd += ['-vf', 'format=nv12,hwupload']
+    cmd += ['-c:v', encoder, '-f', 'null', '-']
+    
+    try:
+        subprocess.run(cmd, capture_output=True, check=True, timeout=30)
+        return True
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return False
+
+@lru_cache(maxsize=None)
+def _hw_encoder():
+    """Return the first working hardware H.264 encoder, if any.
+
+    Detected on first use and cached, so processes that never encode
+    (e.g. the web workers) don't open encoder sessions.
+    """
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+    for encoder in ('h264_nvenc', 'h264_qsv', 'h264_vaapi'):
+        if encoder in result.stdout and _hw_encoder_works(encoder):
+            return encoder
+    return None
+
+def _software_encode_cmd(input_path, output_path, profile):
+    """Build the libx264 encode command for a profile."""
+    return [
         'ffmpeg',
         '-i', input_path,
         '-c:v', 'libx264',
         '-preset', 'medium',
         '-crf', '23',
-        '-s', profile['resolution'],
-        '-b:v', profile['video_bitrate'],
+        '-s', profile.res_str,
+        '-b:v', profile.vbr_str,
         '-c:a', 'aac',
-        '-b:a', profile['audio_bitrate'],
-        '-r', str(profile['fps']),
+        '-b:a', profile.abr_str,
+        '-r', str(profile.fps),
         '-movflags', '+faststart',
         '-y',
         output_path
     ]
-    
+
+def _hardware_encode_cmd(input_path, output_path, profile, encoder):
+    """Build an encode command that keeps decode, scale and encode on the device."""
+    if encoder == 'h264_nvenc':
+        input_args = ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda']
+        video_args = [
+            '-vf', f'scale_npp={profile.width}:{profile.height}',
+            '-c:v', 'h264_nvenc',
+            '-preset', 'p4',
+            '-rc', 'vbr'
+        ]
+    elif encoder == 'h264_qsv':
+        input_args = ['-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv']
+        video_args = [
+            '-vf', f'scale_qsv=w={profile.width}:h={profile.height}',
+            '-c:v', 'h264_qsv'
+        ]
+    else:
+        input_args = [
+            '-vaapi_device', VAAPI_DEVICE,
+            '-hwaccel', 'vaapi',
+            '-hwaccel_output_format', 'vaapi'
+        ]
+        video_args = [
+            '-vf', f'scale_vaapi=w={profile.width}:h={profile.height},format=nv12',
+            '-c:v', 'h264_vaapi'
+        ]
+
+    return [
+        'ffmpeg',
+        *input_args,
+        '-i', input_path,
+        *video_args,
+        '-b:v', profile.vbr_str,
+        '-c:a', 'aac',
+        '-b:a', profile.abr_str,
+        '-r', str(profile.fps),
+        '-movflags', '+faststart',
+        '-y',
+        output_path
+    ]
+
+PROGRESS_INTERVAL = 1.0  # Minimum seconds between progress updates
+
+def run_ffmpeg(cmd, job_id=None, label='video', duration=0):
+    """Run an FFmpeg command, streaming its progress into the job status.
+
+    Progress is read from ``-progress pipe:1`` line by line instead of
+    buffering FFmpeg's output, and written at most once per
+    PROGRESS_INTERVAL. Returns True if FFmpeg exited successfully.
+    """
+    cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                text=True, bufsize=1)
+    except OSError as e:
+        print(f"Error starting FFmpeg: {e}")
+        return False
+
+    last_update = 0
     try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        for line in proc.stdout:
+            key, _, value = line.strip().partition('=')
+            # out_time_ms is reported in microseconds despite its name
+            if key == 'out_time_ms' and value.isdigit() and job_id:
+                now = time.monotonic()
+                if now - last_update < PROGRESS_INTERVAL:
+                    continue
+                last_update = now
+                seconds = int(value) // 1_000_000
+                if duration:
+                    percent = min(seconds / duration * 100, 100)
+                    update_job_status(job_id, 'processing', f'Encoding {label} ({percent:.0f}%)')
+                else:
+                    update_job_status(job_id, 'processing', f'Encoding {label} ({seconds}s)')
+        returncode = proc.wait()
+    except BaseException:
+        # Don't leave FFmpeg running (e.g. on a Redis error or RQ job timeout)
+        proc.kill()
+        proc.wait()
+        raise
+
+    if returncode != 0:
+        print(f"Error encoding {label}: ffmpeg exited with code {returncode}")
+        return False
+    return True
+
+def encode_video(input_path, output_path, profile, job_id=None, quality='video', duration=0):
+    """Encode video using FFmpeg with the specified profile.
+
+    Uses the detected hardware encoder when available and falls back to
+    libx264 if the hardware encode fails.
+    """
+    hw_encoder = _hw_encoder()
+    if hw_encoder:
+        cmd = _hardware_encode_cmd(input_path, output_path, profile, hw_encoder)
+        if run_ffmpeg(cmd, job_id, quality, duration):
+            return True
+        print(f"Hardware encode with {hw_encoder} failed, using libx264")
+
+    cmd = _software_encode_cmd(input_path, output_path, profile)
+    return run_ffmpeg(cmd, job_id, quality, duration)
+
+def hls_paths(output_path):
+    """Return the HLS playlist path and segment pattern for an MP4 output."""
+    base = os.path.splitext(output_path)[0]
+    return f"{base}.m3u8", f"{base}_%03d.ts"
+
+def _ladder_video_args(profile, encoder):
+    """Video scale and encode arguments for one rendition of the ladder.
+
+    Decoding and scaling stay on the CPU so the shared decoded frames can
+    also feed the thumbnail; only the encode runs on the hardware encoder.
+    """
+    if encoder == 'h264_nvenc':
+        return ['-s', profile.res_str, '-c:v', 'h264_nvenc', '-preset', 'p4', '-rc', 'vbr']
+    if encoder == 'h264_qsv':
+        return ['-s', profile.res_str, '-c:v', 'h264_qsv']
+    if encoder == 'h264_vaapi':
+        return ['-vf', f'scale={profile.width}:{profile.height},format=nv12,hwupload',
+                '-c:v', 'h264_vaapi']
+    return ['-s', profile.res_str, '-c:v', 'libx264', '-preset', 'medium', '-crf', '23']
+
+def remove_hls_output(renditions):
+    """Delete any HLS playlists and segments written for the renditions."""
+    for quality, profile, output_path in renditions:
+        playlist_path, _ = hls_paths(output_path)
+        for path in [playlist_path] + glob.glob(os.path.splitext(output_path)[0] + '_*.ts'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def encode_ladder(input_path, renditions, thumbnail_path, job_id=None, duration=0, encoder=None):
+    """Encode every rendition and the thumbnail in a single FFmpeg run.
+
+    The input is opened and decoded once; each rendition gets its own
+    encoder fed from the shared decoded frames. Each encoded rendition is
+    written both as a faststart MP4 and as a VOD HLS playlist.
+
+    Uses the detected hardware encoder by default and retries with libx264
+    if the hardware run fails.
+    """
+    encoder = encoder or _hw_encoder() or 'libx264'
+    cmd = ['ffmpeg', '-y']
+    if encoder == 'h264_vaapi':
+        cmd += ['-vaapi_device', VAAPI_DEVICE]
+    cmd += ['-i', input_path]
+    for quality, profile, output_path in renditions:
+        playlist_path, segment_pattern = hls_paths(output_path)
+        cmd += [
+            '-map', '0:v:0',
+            '-map', '0:a:0?',
+            *_ladder_video_args(profile, encoder),
+            '-b:v', profile.vbr_str,
+            '-c:a', 'aac',
+            '-b:a', profile.abr_str,
+            '-r', str(profile.fps),
+            # Keyframe on every segment boundary so HLS segments are even
+            '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})',
+            '-flags', '+global_header',
+            '-f', 'tee',
+            f'[f=mp4:movflags=+faststart]{output_path}|'
+            f'[f=hls:hls_time={HLS_SEGMENT_SECONDS}:hls_playlist_type=vod:'
+            f'hls_segment_filename={segment_pattern}]{playlist_path}'
+        ]
+    # The input is decoded for the renditions anyway, so trimming here is free
+    cmd += [
+        '-map', '0:v:0',
+        '-vf', f'trim=start=1,{THUMBNAIL_FILTER}',
+        '-frames:v', '1',
+        '-q:v', '2',
+        thumbnail_path
+    ]
+
+    if run_ffmpeg(cmd, job_id, f'{len(renditions)} formats', duration):
         return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error encoding video: {e}")
+    if encoder != 'libx264':
+        print(f"Hardware encode with {encoder} failed, using libx264")
+        remove_hls_output(renditions)
+        return encode_ladder(input_path, renditions, thumbnail_path, job_id, duration, 'libx264')
+    return False
+
+def write_master_playlist(master_path, renditions):
+    """Write an HLS master playlist for the renditions that have a playlist.
+
+    Returns False if no rendition was encoded to HLS.
+    """
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for quality, profile, output_path in renditions:
+        playlist_path, _ = hls_paths(output_path)
+        if os.path.exists(playlist_path):
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={profile.vbr_bps + profile.abr_bps},"
+                         f"RESOLUTION={profile.res_str}")
+            lines.append(os.path.basename(playlist_path))
+    
+    if len(lines) == 2:
         return False
+    
+    with open(master_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return True
 
 def process_video_job(job_data):
-    """Process a video encoding job."""
+    """Process a video encoding job.
+
+    The source is either a local file (``input_path``) or an object that was
+    uploaded directly to S3 (``s3_input_key``).
+    """
     job_id = job_data['job_id']
-    input_path = job_data['input_path']
     video_id = job_data['video_id']
+    input_path = None
+    rq_job = get_current_job()
+    will_retry = False
     
     try:
         # Update job status
         update_job_status(job_id, 'processing', 'Starting video processing')
         
+        if job_data.get('s3_input_key'):
+            s3_input_key = job_data['s3_input_key']
+            input_path = os.path.join(UPLOAD_FOLDER, f"{video_id}_original.{s3_input_key.rsplit('.', 1)[-1]}")
+            s3_client.download_file(S3_BUCKET, s3_input_key, input_path)
+        else:
+            input_path = job_data['input_path']
+        
         # Get video information
         video_info = get_video_info(input_path)
         if not video_info:
@@ -171,159 +558,434 @@ def process_video_job(job_data):
             update_job_status(job_id, 'error', 'No video stream found')
             return
         
-        # Determine which profiles to encode based on input resolution
+        # Determine which profiles to encode based on input resolution,
+        # bitrate and frame rate
         input_width = int(video_stream.get('width', 0))
         input_height = int(video_stream.get('height', 0))
+        src_bitrate = int(video_info['format'].get('bit_rate', 0))
+        num, _, den = video_stream.get('r_frame_rate', '30/1').partition('/')
+        src_frame_rate = Fraction(int(num), max(int(den or 1), 1))
         
-        # Select appropriate profiles
+        # Select appropriate profiles, skipping rungs that would need more
+        # bitrate than the source has
         profiles_to_encode = []
         for quality, profile in ENCODING_PROFILES.items():
-            profile_width, profile_height = map(int, profile['resolution'].split('x'))
-            if profile_height <= input_height:
-                profiles_to_encode.append((quality, profile))
+            if profile.height > input_height:
+                continue
+            if src_bitrate and profile.vbr_bps > src_bitrate * 1.1:
+                continue
+            profiles_to_encode.append((quality, profile))
         
         if not profiles_to_encode:
-            # If input is very low resolution, use the lowest profile
+            # If input is very low resolution or bitrate, use the lowest profile
             profiles_to_encode = [('240p', ENCODING_PROFILES['240p'])]
         
-        # Create thumbnail
-        thumbnail_path = os.path.join(PROCESSED_FOLDER, f"{video_id}_thumbnail.jpg")
-        create_thumbnail(input_path, thumbnail_path)
+        # Never raise the frame rate above the source
+        profiles_to_encode = [
+            (quality, profile._replace(fps=src_frame_rate) if 0 < src_frame_rate < profile.fps else profile)
+            for quality, profile in profiles_to_encode
+        ]
         
-        # Encode videos
-        encoded_files = []
-        total_profiles = len(profiles_to_encode)
+        output_prefix = f"{PROCESSED_FOLDER}/{video_id}_"
+        thumbnail_path = output_prefix + "thumbnail.jpg"
+        renditions = [
+            (quality, profile, output_prefix + f"{quality}.mp4")
+            for quality, profile in profiles_to_encode
+        ]
+        duration = float(video_info['format'].get('duration', 0))
         
-        for i, (quality, profile) in enumerate(profiles_to_encode):
-            update_job_status(job_id, 'processing', f'Encoding {quality} ({i+1}/{total_profiles})')
-            
-            output_filename = f"{video_id}_{quality}.mp4"
-            output_path = os.path.join(PROCESSED_FOLDER, output_filename)
-            
-            if encode_video(input_path, output_path, profile):
-                file_size = os.path.getsize(output_path)
-                encoded_files.append({
-                    'quality': quality,
-                    'filename': output_filename,
-                    'path': output_path,
-                    'size': file_size,
-                    'bitrate': int(profile['video_bitrate'].rstrip('k')) * 1000
-                })
-            else:
-                print(f"Failed to encode {quality} for video {video_id}")
+        # Encode all formats and the thumbnail in one pass
+        update_job_status(job_id, 'processing', f'Encoding {len(renditions)} formats')
+        if not encode_ladder(input_path, renditions, thumbnail_path, job_id, duration):
+            # Fall back to encoding each format separately; the fallback only
+            # produces MP4, so drop any partial HLS output
+            print(f"Single-pass encode failed for video {video_id}, encoding formats separately")
+            remove_hls_output(renditions)
+            create_thumbnail(input_path, thumbnail_path)
+            total_profiles = len(renditions)
+            for i, (quality, profile, output_path) in enumerate(renditions):
+                update_job_status(job_id, 'processing', f'Encoding {quality} ({i+1}/{total_profiles})')
+                if not encode_video(input_path, output_path, profile, job_id, quality, duration):
+                    print(f"Failed to encode {quality} for video {video_id}")
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+        
+        encoded_files = []
+        for quality, profile, output_path in renditions:
+            # One stat per rendition covers both the existence check and the size
+            try:
+                file_size = os.stat(output_path).st_size
+            except FileNotFoundError:
+                continue
+            encoded_files.append({
+                'quality': quality,
+                'filename': os.path.basename(output_path),
+                'path': output_path,
+                'size': file_size,
+                'bitrate': profile.vbr_bps
+            })
         
         if not encoded_files:
             update_job_status(job_id, 'error', 'Failed to encode any video formats')
             return
         
+        has_thumbnail = os.path.exists(thumbnail_path)
+        
+        # HLS playlists and segments, served from the same folder as the MP4s
+        master_path = output_prefix + "master.m3u8"
+        hls_files = []
+        if write_master_playlist(master_path, renditions):
+            hls_files = [master_path] + glob.glob(output_prefix + "*.m3u8") + glob.glob(output_prefix + "*.ts")
+            hls_files = list(dict.fromkeys(hls_files))
+        
         # Upload to cloud storage if available
         if s3_client:
             update_job_status(job_id, 'processing', 'Uploading to cloud storage')
+            
+            # Upload all formats, HLS files and the thumbnail concurrently
+            with ThreadPoolExecutor(max_workers=len(encoded_files) + 1) as executor:
+                futures = [
+                    executor.submit(upload_to_s3, encoded_file['path'], f"videos/{encoded_file['filename']}")
+                    for encoded_file in encoded_files
+                ]
+                futures += [
+                    executor.submit(upload_to_s3, hls_file, f"videos/{os.path.basename(hls_file)}")
+                    for hls_file in hls_files
+                ]
+                if has_thumbnail:
+                    futures.append(executor.submit(upload_to_s3, thumbnail_path, f"thumbnails/{video_id}_thumbnail.jpg"))
+                # Fail the job (and let RQ retry it) rather than publish
+                # URLs for objects that never made it to S3
+                if not all(future.result() for future in futures):
+                    raise RuntimeError('Failed to upload to cloud storage')
+            
             for encoded_file in encoded_files:
-                upload_to_s3(encoded_file['path'], f"videos/{encoded_file['filename']}")
                 encoded_file['url'] = f"https://{S3_BUCKET}.s3.amazonaws.com/videos/{encoded_file['filename']}"
             
-            # Upload thumbnail
-            if os.path.exists(thumbnail_path):
-                upload_to_s3(thumbnail_path, f"thumbnails/{video_id}_thumbnail.jpg")
+            if has_thumbnail:
                 thumbnail_url = f"https://{S3_BUCKET}.s3.amazonaws.com/thumbnails/{video_id}_thumbnail.jpg"
             else:
                 thumbnail_url = None
+            hls_url = f"https://{S3_BUCKET}.s3.amazonaws.com/videos/{video_id}_master.m3u8" if hls_files else None
         else:
             # Use local URLs
             for encoded_file in encoded_files:
                 encoded_file['url'] = f"http://localhost:5000/processed/{encoded_file['filename']}"
-            thumbnail_url = f"http://localhost:5000/processed/{video_id}_thumbnail.jpg" if os.path.exists(thumbnail_path) else None
+            thumbnail_url = f"http://localhost:5000/processed/{video_id}_thumbnail.jpg" if has_thumbnail else None
+            hls_url = f"http://localhost:5000/processed/{video_id}_master.m3u8" if hls_files else None
         
         # Update job with results
         result_data = {
             'encoded_files': encoded_files,
             'thumbnail_url': thumbnail_url,
-            'duration': float(video_info['format'].get('duration', 0)),
+            'hls_url': hls_url,
+            'duration': duration,
             'video_info': {
                 'width': input_width,
                 'height': input_height,
                 'codec': video_stream.get('codec_name'),
-                'fps': eval(video_stream.get('r_frame_rate', '30/1'))
+                'fps': float(src_frame_rate)
             }
         }
         
         update_job_status(job_id, 'completed', 'Video processing completed successfully', result_data)
         
-        # Clean up input file
-        os.remove(input_path)
-        
     except Exception as e:
-        update_job_status(job_id, 'error', f'Unexpected error: {str(e)}')
+        will_retry = bool(rq_job and rq_job.retries_left)
+        if will_retry:
+            update_job_status(job_id, 'processing', f'Retrying after error: {str(e)}')
+        else:
+            update_job_status(job_id, 'error', f'Unexpected error: {str(e)}')
         print(f"Error processing video job {job_id}: {e}")
+        if rq_job:
+            # Let RQ retry the job or mark it failed (this includes job timeouts)
+            raise
+    
+    finally:
+        # Clean up input file; uploads live in memory-backed storage.
+        # Keep it for RQ's next attempt.
+        if input_path and not will_retry and os.path.exists(input_path):
+            os.remove(input_path)
 
 def upload_to_s3(local_path, s3_key):
     """Upload file to S3."""
     try:
-        s3_client.upload_file(local_path, S3_BUCKET, s3_key)
+        content_type = mimetypes.guess_type(local_path)[0] or 'application/octet-stream'
+        s3_client.upload_file(local_path, S3_BUCKET, s3_key,
+                              ExtraArgs={'ContentType': content_type}, Config=S3_TRANSFER_CONFIG)
         return True
     except Exception as e:
         print(f"Error uploading to S3: {e}")
         return False
 
-def update_job_status(job_id, status, message, data=None):
-    """Update job status in Redis."""
-    if not redis_client:
-        print(f"Job {job_id}: {status} - {message}")
-        return
-    
+JOB_TTL = 3600  # Job status expires after 1 hour
+
+# Short field names used for job results stored in Redis
+_JOB_DATA_WIRE_KEYS = {
+    'encoded_files': 'ef',
+    'thumbnail_url': 'tu',
+    'hls_url': 'hu',
+    'duration': 'du',
+    'video_info': 'vi',
+    'quality': 'q',
+    'filename': 'fn',
+    'path': 'p',
+    'size': 's',
+    'bitrate': 'br',
+    'url': 'u',
+    'width': 'w',
+    'height': 'h',
+    'codec': 'c',
+    'fps': 'fr'
+}
+_JOB_DATA_FIELD_NAMES = {short: name for name, short in _JOB_DATA_WIRE_KEYS.items()}
+
+def _rename_keys(value, names):
+    """Recursively rename dict keys found in names."""
+    if isinstance(value, dict):
+        return {names.get(key, key): _rename_keys(item, names) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_rename_keys(item, names) for item in value]
+    return value
+
+def pack_job_data(data):
+    """Encode a job result for Redis as zstd-compressed msgpack with short keys."""
+    packed = msgpack.packb(_rename_keys(data, _JOB_DATA_WIRE_KEYS))
+    return zstandard.ZstdCompressor(level=3).compress(packed)
+
+def unpack_job_data(blob):
+    """Decode a job result written by pack_job_data."""
+    packed = zstandard.ZstdDecompressor().decompress(blob)
+    return _rename_keys(msgpack.unpackb(packed), _JOB_DATA_FIELD_NAMES)
+
+TERMINAL_STATUSES = ('completed', 'error')
+
+def _queue_job_status(pipe, job_id, status, message, data=None):
+    """Queue the commands for a job status update on a Redis pipeline.
+
+    In-progress updates are written as fields of a hash. Terminal states
+    and updates carrying result data replace it with a single packed value.
+    """
     job_data = {
         'status': status,
         'message': message,
         'updated_at': datetime.now().isoformat()
     }
     
-    if data:
-        job_data['data'] = data
+    if status in TERMINAL_STATUSES or data:
+        if data:
+            job_data['data'] = data
+        pipe.set(f"job:{job_id}", pack_job_data(job_data), ex=JOB_TTL)
+        return
+    
+    pipe.hset(f"job:{job_id}", mapping=job_data)
+    pipe.expire(f"job:{job_id}", JOB_TTL)
+
+def _write_job_status(job_id, status, message, data=None):
+    """Write a job status update in one round-trip."""
+    pipe = redis_client.pipeline(transaction=False)
+    _queue_job_status(pipe, job_id, status, message, data)
+    try:
+        pipe.execute()
+    except redis.ResponseError as e:
+        # A retried job finds the terminal value of its previous run, which
+        # HSET rejects with WRONGTYPE; clear it and write again. Anything
+        # else (OOM, read-only replica, ...) must not wipe the status.
+        # Pipelines prefix the server error with "Command # n (...) of
+        # pipeline caused error: "
+        if not str(e).rpartition('caused error: ')[2].startswith('WRONGTYPE'):
+            raise
+        pipe.delete(f"job:{job_id}")
+        _queue_job_status(pipe, job_id, status, message, data)
+        pipe.execute()
+
+def update_job_status(job_id, status, message, data=None):
+    """Update job status in Redis."""
+    if not redis_client:
+        print(f"Job {job_id}: {status} - {message}")
+        return
     
-    redis_client.hmset(f"job:{job_id}", job_data)
-    redis_client.expire(f"job:{job_id}", 3600)  # Expire after 1 hour
+    _write_job_status(job_id, status, message, data)
+
+@app.teardown_request
+def remove_spooled_uploads(exc=None):
+    """Delete spooled uploads that were not moved into place."""
+    for spool_path in getattr(request, 'spooled_uploads', ()):
+        try:
+            os.remove(spool_path)
+        except FileNotFoundError:
+            pass
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
     return jsonify({'status': 'healthy', 'service': 'video-processor'})
 
-@app.route('/process', methods=['POST'])
-def process_video():
-    """Start video processing job."""
+def dispatch_job(job_data):
+    """Queue a job for the encode workers.
+
+    Falls back to a background thread when Redis is not available.
+    """
+    if job_queue:
+        # Jobs can wait in the queue for a while; make them visible to /job
+        update_job_status(job_data['job_id'], 'queued', 'Waiting for an encode worker')
+        # Referenced by path so workers can import it when app.py runs as __main__
+        job_queue.enqueue('app.process_video_job', job_data,
+                          job_id=job_data['job_id'], job_timeout=3600, retry=Retry(max=2))
+        return
+    
+    thread = threading.Thread(target=process_video_job, args=(job_data,))
+    thread.daemon = True
+    thread.start()
+
+def _s3_key_from_payload(payload):
+    """Extract the uploaded object key from a /process JSON body.
+
+    Accepts ``{"s3_key": ...}``, a raw S3 event notification, or an S3 event
+    wrapped in an SNS HTTP(S) ``Notification`` envelope.
+    """
+    if payload.get('Type') == 'Notification':
+        try:
+            payload = json.loads(payload.get('Message') or '{}')
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(payload, dict):
+            return None
+    if payload.get('s3_key'):
+        return str(payload['s3_key'])
+    try:
+        return unquote_plus(payload['Records'][0]['s3']['object']['key'])
+    except (KeyError, IndexError, TypeError):
+        return None
+
+def _is_uuid(value):
+    """Return True if value is a canonical UUID string."""
+    try:
+        return str(uuid.UUID(value)) == value
+    except ValueError:
+        return False
+
+def confirm_sns_subscription(payload):
+    """Confirm an SNS HTTP(S) subscription to this endpoint."""
+    subscribe_url = payload.get('SubscribeURL', '')
+    parsed = urlparse(subscribe_url)
+    # Only follow confirmation links that point back at SNS
+    if parsed.scheme != 'https' or not (parsed.hostname or '').endswith('.amazonaws.com'):
+        return jsonify({'error': 'Invalid subscription URL'}), 400
+    
+    urlopen(subscribe_url, timeout=10).close()
+    return jsonify({'status': 'subscribed'})
+
+@app.route('/presign', methods=['POST'])
+def presign_upload():
+    """Return a presigned URL so the client can upload straight to S3."""
+    if not s3_client:
+        return jsonify({'error': 'Direct uploads not available'}), 503
+    
+    payload = request.get_json(silent=True) or {}
+    file_extension = get_file_extension(payload.get('filename', ''))
+    if file_extension not in ALLOWED_EXTENSIONS:
+        return jsonify({'error': 'Invalid file'}), 400
+    
     try:
-        if 'video' not in request.files:
-            return jsonify({'error': 'No video file provided'}), 400
-        
-        file = request.files['video']
-        if file.filename == '' or not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file'}), 400
-        
-        # Generate unique identifiers
         job_id = str(uuid.uuid4())
         video_id = str(uuid.uuid4())
+        s3_key = f"uploads/{video_id}.{file_extension}"
+        
+        upload_url = s3_client.generate_presigned_url(
+            'put_object',
+            Params={'Bucket': S3_BUCKET, 'Key': s3_key},
+            ExpiresIn=3600
+        )
         
-        # Save uploaded file
-        filename = secure_filename(file.filename)
-        file_extension = filename.rsplit('.', 1)[1].lower()
-        input_filename = f"{video_id}_original.{file_extension}"
-        input_path = os.path.join(UPLOAD_FOLDER, input_filename)
-        file.save(input_path)
+        # Remember which job the upload belongs to until it lands
+        if redis_client:
+            redis_client.setex(f"upload:{video_id}", 3600, job_id)
+        update_job_status(job_id, 'pending', 'Waiting for upload')
         
-        # Create job data
-        job_data = {
+        return jsonify({
             'job_id': job_id,
             'video_id': video_id,
-            'input_path': input_path,
-            'original_filename': filename,
-            'created_at': datetime.now().isoformat()
-        }
+            's3_key': s3_key,
+            'upload_url': upload_url,
+            'expires_in': 3600
+        })
         
-        # Start processing in background thread
-        thread = threading.Thread(target=process_video_job, args=(job_data,))
-        thread.daemon = True
-        thread.start()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/process', methods=['POST'])
+def process_video():
+    """Start video processing job.
+
+    Takes either a multipart ``video`` upload or a JSON body naming an
+    object already uploaded to S3 through ``/presign``. S3 event
+    notifications can be delivered directly or through an SNS HTTP(S)
+    subscription, whose confirmation handshake is answered here too.
+    """
+    try:
+        if 'video' in request.files:
+            file = request.files['video']
+            file_extension = get_file_extension(file.filename)
+            if file_extension not in ALLOWED_EXTENSIONS:
+                return jsonify({'error': 'Invalid file'}), 400
+            
+            # Generate unique identifiers
+            job_id = str(uuid.uuid4())
+            video_id = str(uuid.uuid4())
+            
+            # Save uploaded file
+            filename = secure_filename(file.filename)
+            input_filename = f"{video_id}_original.{file_extension}"
+            input_path = os.path.join(UPLOAD_FOLDER, input_filename)
+            save_upload(file, input_path)
+            
+            # Create job data
+            job_data = {
+                'job_id': job_id,
+                'video_id': video_id,
+                'input_path': input_path,
+                'original_filename': filename,
+                'created_at': datetime.now().isoformat()
+            }
+        else:
+            # SNS posts JSON with a text/plain content type
+            payload = request.get_json(force=True, silent=True)
+            if not isinstance(payload, dict):
+                return jsonify({'error': 'No video file provided'}), 400
+            if payload.get('Type') == 'SubscriptionConfirmation':
+                return confirm_sns_subscription(payload)
+            
+            s3_key = _s3_key_from_payload(payload)
+            if not s3_key:
+                return jsonify({'error': 'No video file provided'}), 400
+            if not s3_client:
+                return jsonify({'error': 'Direct uploads not available'}), 503
+            if not s3_key.startswith('uploads/') or not allowed_file(s3_key):
+                return jsonify({'error': 'Invalid file'}), 400
+            
+            # Only objects named by /presign are processed; the video id ends
+            # up in output paths and glob patterns
+            video_id = os.path.basename(s3_key).rsplit('.', 1)[0]
+            if s3_key != f"uploads/{os.path.basename(s3_key)}" or not _is_uuid(video_id):
+                return jsonify({'error': 'Invalid file'}), 400
+            if redis_client:
+                job_id = redis_client.get(f"upload:{video_id}")
+                if not job_id:
+                    return jsonify({'error': 'Unknown upload'}), 404
+                job_id = job_id.decode()
+            else:
+                job_id = str(uuid.uuid4())
+            
+            job_data = {
+                'job_id': job_id,
+                'video_id': video_id,
+                's3_input_key': s3_key,
+                'original_filename': os.path.basename(s3_key),
+                'created_at': datetime.now().isoformat()
+            }
+        
+        dispatch_job(job_data)
         
         return jsonify({
             'job_id': job_id,
@@ -332,6 +994,9 @@ def process_video():
             'message': 'Video processing job started'
         })
         
+    except HTTPException:
+        # e.g. 413 when the upload exceeds MAX_CONTENT_LENGTH
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -341,16 +1006,37 @@ def get_job_status(job_id):
     if not redis_client:
         return jsonify({'error': 'Job tracking not available'}), 503
     
-    job_data = redis_client.hgetall(f"job:{job_id}")
+    key = f"job:{job_id}"
+    if redis_client.type(key) == b'string':
+        # Finished jobs are stored as one packed value
+        blob = redis_client.get(key)
+        if blob:
+            return jsonify(unpack_job_data(blob))
+    
+    job_data = redis_client.hgetall(key)
     if not job_data:
         return jsonify({'error': 'Job not found'}), 404
     
-    return jsonify(job_data)
+    return jsonify({key.decode(): value.decode() for key, value in job_data.items()})
 
 @app.route('/processed/<filename>')
 def serve_processed_file(filename):
-    """Serve processed video files."""
-    return app.send_static_file(os.path.join(PROCESSED_FOLDER, filename))
+    """Serve processed video files.
+
+    Behind nginx the transfer is delegated with X-Accel-Redirect so the
+    worker is released immediately and nginx sends the file itself.
+    """
+    if ACCEL_REDIRECT_PREFIX:
+        filename = secure_filename(filename)
+        if not os.path.isfile(os.path.join(PROCESSED_FOLDER, filename)):
+            return jsonify({'error': 'File not found'}), 404
+        
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{filename}"
+        response.headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return response
+    
+    return send_from_directory(PROCESSED_FOLDER, filename)
 
 if __name__ == '__main__':
     # Check for FFmpeg
@@ -361,5 +1047,6 @@ if __name__ == '__main__':
         print("ERROR: FFmpeg not found. Please install FFmpeg.")
         exit(1)
     
+    # Development server only; production runs under gunicorn (see wsgi.py)
     print("Starting VidioX Video Processing Service...")
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG', 'false').lower() == 'true')
\ No newline at end of file
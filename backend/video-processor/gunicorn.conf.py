@@ -0,0 +1,16 @@
+"""
+Gunicorn configuration for the VidioX Video Processing Service
+
+Each worker process has its own Redis connection pool, so keep
+REDIS_MAX_CONNECTIONS >= threads per worker.
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+# Large uploads can take a long time to arrive
+timeout = 3600
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+VidioX Encoding Worker
+Runs queued video processing jobs from the Redis 'encode' queue
+
+Start one worker per hardware encoder slot (NVENC allows ~2 sessions on
+consumer GPUs) or per (CPU cores / x264 threads per job), e.g.:
+
+    rq worker-pool encode -n 4
+    python worker.py
+"""
+
+from rq import Worker
+
+from app import job_queue
+
+if __name__ == '__main__':
+    if not job_queue:
+        print("ERROR: Redis not available. Cannot start worker.")
+        exit(1)
+    
+    print("Starting VidioX encoding worker...")
+    Worker([job_queue], connection=job_queue.connection).work()
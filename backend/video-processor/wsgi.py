@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+"""
+VidioX Video Processing Service WSGI entry point
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from app import app